@@ -1,14 +1,63 @@
 import streamlit as st
 from PIL import Image
-import tempfile
-import os
+import threading
+import uuid
 from image_captioning import DualImageCaptioning
 
-# Initialize the captioning system (cached to avoid reloading models)
+# Weight precisions offered in the sidebar (int8/nf4 use bitsandbytes and require a CUDA GPU)
+PRECISIONS = ["fp16", "int8", "nf4"]
+
+# Process-wide record of the server precision, the current captioner and the threads preloading its models
 @st.cache_resource
-def load_captioner():
-    """Load and cache the dual image captioning models"""
-    return DualImageCaptioning()
+def captioner_registry():
+    """Create the registry shared by every session"""
+    return {"precision": PRECISIONS[0], "captioner": None, "preloads": [], "lock": threading.Lock()}
+
+# Initialize the captioning system (cached to avoid reloading models)
+@st.cache_resource(max_entries=1)
+def load_captioner(precision="fp16"):
+    """Create and cache the dual image captioning system; models load on first use"""
+    registry = captioner_registry()
+    with registry["lock"]:
+        # Stop preloads for the previous precision and free its models before building
+        # the new captioner, so two copies of the models are never resident at once
+        for _, cancel in registry["preloads"]:
+            cancel.set()
+        for thread, _ in registry["preloads"]:
+            thread.join()
+        registry["preloads"] = []
+        
+        if registry["captioner"] is not None:
+            registry["captioner"].close()
+        registry["captioner"] = DualImageCaptioning(quantization=precision)
+        return registry["captioner"]
+
+def current_captioner():
+    """Return the captioner for the current server precision"""
+    return load_captioner(captioner_registry()["precision"])
+
+# Start loading models in the background
+def preload_captioner(captioner, use_blip=True, use_blip2=True):
+    """Load the selected models from a daemon thread while the user picks an image"""
+    cancel = threading.Event()
+    
+    def preload():
+        # A precision switch cancels the preload between models
+        if use_blip and not cancel.is_set():
+            captioner.load_blip()
+        if use_blip2 and not cancel.is_set():
+            captioner.load_blip2()
+    
+    thread = threading.Thread(target=preload, daemon=True)
+    registry = captioner_registry()
+    with registry["lock"]:
+        # Another session may have switched precision since this captioner was fetched
+        if registry["captioner"] is not captioner:
+            return None
+        registry["preloads"] = [(t, c) for t, c in registry["preloads"] if t.is_alive()]
+        registry["preloads"].append((thread, cancel))
+        thread.start()
+    return thread
 
 def main():
     st.title("🖼️ Image Captioning with BLIP and BLIP-2 Models")
@@ -28,6 +77,40 @@ def main():
         ("BLIP Only", "BLIP-2 Only", "Both Models (Comparison)")
     )
     
+    # Every session shares one captioner, so precision is a server-wide setting; a
+    # per-session choice would make sessions on different precisions evict each other.
+    # Follow switches made by other sessions before drawing the widget
+    registry = captioner_registry()
+    if st.session_state.get("server_precision") != registry["precision"]:
+        st.session_state["server_precision"] = registry["precision"]
+        st.session_state["precision"] = registry["precision"]
+    
+    precision = st.sidebar.selectbox(
+        "Precision (all sessions)",
+        PRECISIONS,
+        key="precision",
+        help="Lower precision reduces GPU memory usage (int8 and nf4 require a CUDA GPU)"
+    )
+    st.sidebar.caption("Precision applies to every open session; changing it reloads the models for all of them.")
+    
+    if precision != registry["precision"]:
+        with registry["lock"]:
+            registry["precision"] = precision
+        st.session_state["server_precision"] = precision
+    
+    # Models no open session uses are released; every rerun refreshes this session's
+    # selection so another session switching options does not evict its models
+    captioner = current_captioner()
+    session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+    use_blip = model_option != "BLIP-2 Only"
+    use_blip2 = model_option != "BLIP Only"
+    captioner.select_models(session_id, blip=use_blip, blip2=use_blip2)
+    
+    # Preload once per selection in this session rather than on every rerun
+    if st.session_state.get("preloaded") != (precision, model_option):
+        st.session_state["preloaded"] = (precision, model_option)
+        preload_captioner(captioner, use_blip, use_blip2)
+    
     # File uploader
     uploaded_file = st.file_uploader(
         "Choose an image...", 
@@ -38,6 +121,9 @@ def main():
     if uploaded_file is not None:
         # Display the uploaded image
         raw_image = Image.open(uploaded_file).convert('RGB')
+        
+        # Downscale oversized uploads; still >2x the 384px the processors resize to
+        raw_image.thumbnail((768, 768), Image.Resampling.BILINEAR)
         st.image(raw_image, caption='Uploaded Image', use_column_width=True)
         
         # Advanced options
@@ -49,12 +135,21 @@ def main():
                     help="Text prompt to guide BLIP caption generation"
                 )
             
-            if model_option in ["BLIP-2 Only", "Both Models (Comparison)"]:
+            if model_option == "BLIP-2 Only":
                 blip2_prompt = st.text_area(
                     "BLIP-2 Prompt:", 
                     value="Describe this image in detail with at least three sentences.",
                     help="Text prompt to guide BLIP-2 caption generation"
                 )
+            
+            if model_option == "Both Models (Comparison)":
+                blip2_prompts = st.text_area(
+                    "BLIP-2 Prompts (one per line):", 
+                    value="Describe this image in detail with at least three sentences.",
+                    help="Each line is a separate BLIP-2 prompt; all prompts run in a single batch"
+                )
+            
+            if model_option in ["BLIP-2 Only", "Both Models (Comparison)"]:
                 max_tokens = st.slider(
                     "Max New Tokens (BLIP-2):", 
                     min_value=50, 
@@ -68,67 +163,70 @@ def main():
             try:
                 with st.spinner('Loading models and generating captions...'):
                     # Load the captioner (cached)
-                    captioner = load_captioner()
-                    
-                    # Save uploaded file temporarily
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-                        tmp_file.write(uploaded_file.getvalue())
-                        tmp_file_path = tmp_file.name
+                    captioner = current_captioner()
                     
-                    try:
-                        if model_option == "BLIP Only":
-                            # Generate BLIP caption only
-                            caption = captioner.generate_blip_caption(
-                                tmp_file_path, 
-                                text_prompt=blip_prompt if 'blip_prompt' in locals() else "a photography of"
-                            )
-                            st.success("Caption generated successfully!")
-                            st.write("### 🔍 BLIP Caption:")
-                            st.info(caption)
-                            
-                        elif model_option == "BLIP-2 Only":
-                            # Generate BLIP-2 caption only
-                            caption = captioner.generate_blip2_caption(
-                                tmp_file_path, 
-                                prompt=blip2_prompt if 'blip2_prompt' in locals() else "Describe this image in detail with at least three sentences.",
-                                max_new_tokens=max_tokens if 'max_tokens' in locals() else 200
-                            )
-                            st.success("Caption generated successfully!")
-                            st.write("### 🔍 BLIP-2 Caption:")
-                            st.info(caption)
-                            
-                        else:  # Both Models (Comparison)
-                            # Generate captions from both models
-                            captions = captioner.generate_both_captions(
-                                tmp_file_path,
-                                blip_prompt=blip_prompt if 'blip_prompt' in locals() else "a photography of",
-                                blip2_prompt=blip2_prompt if 'blip2_prompt' in locals() else "Describe this image in detail with at least three sentences.",
-                                max_new_tokens=max_tokens if 'max_tokens' in locals() else 200
-                            )
-                            
-                            st.success("Captions generated successfully!")
-                            
-                            # Display captions in columns
-                            col1, col2 = st.columns(2)
-                            
-                            with col1:
-                                st.write("### 🔍 BLIP Caption")
-                                st.info(captions['blip'])
-                            
-                            with col2:
-                                st.write("### 🔍 BLIP-2 Caption")
-                                st.info(captions['blip2'])
-                            
-                            # Add comparison section
-                            st.write("### 📊 Comparison Analysis")
-                            st.write("**BLIP** typically provides shorter, more concise captions focusing on the main subject.")
-                            st.write("**BLIP-2** generates more detailed descriptions with better contextual understanding.")
+                    # Hash the upload once so repeat clicks hit the caption cache
+                    image_hash = captioner.hash_image(uploaded_file.getvalue())
                     
-                    finally:
-                        # Clean up temporary file
-                        if os.path.exists(tmp_file_path):
-                            os.unlink(tmp_file_path)
-                            
+                    if model_option == "BLIP Only":
+                        # Generate BLIP caption only
+                        caption = captioner.generate_blip_caption(
+                            raw_image, 
+                            text_prompt=blip_prompt if 'blip_prompt' in locals() else "a photography of",
+                            image_hash=image_hash
+                        )
+                        st.success("Caption generated successfully!")
+                        st.write("### 🔍 BLIP Caption:")
+                        st.info(caption)
+                        
+                    elif model_option == "BLIP-2 Only":
+                        # Generate BLIP-2 caption only
+                        caption = captioner.generate_blip2_caption(
+                            raw_image, 
+                            prompt=blip2_prompt if 'blip2_prompt' in locals() else "Describe this image in detail with at least three sentences.",
+                            max_new_tokens=max_tokens if 'max_tokens' in locals() else 200,
+                            image_hash=image_hash
+                        )
+                        st.success("Caption generated successfully!")
+                        st.write("### 🔍 BLIP-2 Caption:")
+                        st.info(caption)
+                        
+                    else:  # Both Models (Comparison)
+                        # Batch every non-empty BLIP-2 prompt line through one generate()
+                        prompt_lines = blip2_prompts.splitlines() if 'blip2_prompts' in locals() else []
+                        prompt_lines = [line.strip() for line in prompt_lines if line.strip()]
+                        prompt_lines = prompt_lines or ["Describe this image in detail with at least three sentences."]
+                        
+                        # Generate captions from both models
+                        captions = captioner.generate_both_captions(
+                            raw_image,
+                            blip_prompt=blip_prompt if 'blip_prompt' in locals() else "a photography of",
+                            blip2_prompt=prompt_lines,
+                            max_new_tokens=max_tokens if 'max_tokens' in locals() else 200,
+                            image_hash=image_hash
+                        )
+                        
+                        st.success("Captions generated successfully!")
+                        
+                        # Display captions in columns
+                        col1, col2 = st.columns(2)
+                        
+                        with col1:
+                            st.write("### 🔍 BLIP Caption")
+                            st.info(captions['blip'])
+                        
+                        with col2:
+                            st.write("### 🔍 BLIP-2 Caption")
+                            for prompt, caption in zip(prompt_lines, captions['blip2']):
+                                if len(prompt_lines) > 1:
+                                    st.caption(prompt)
+                                st.info(caption)
+                        
+                        # Add comparison section
+                        st.write("### 📊 Comparison Analysis")
+                        st.write("**BLIP** typically provides shorter, more concise captions focusing on the main subject.")
+                        st.write("**BLIP-2** generates more detailed descriptions with better contextual understanding.")
+                
             except Exception as e:
                 st.error(f"An error occurred: {str(e)}")
                 st.write("Please make sure you have the required dependencies installed:")
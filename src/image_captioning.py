@@ -1,15 +1,46 @@
 from PIL import Image
 from transformers import BlipProcessor, BlipForConditionalGeneration
 from transformers import Blip2Processor, Blip2ForConditionalGeneration
+from transformers import BitsAndBytesConfig
+from transformers import MaxLengthCriteria, StoppingCriteriaList
+from torchvision.transforms import v2
 import torch
+import copy
+import gc
+import hashlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+# Number of generated captions kept in the per-instance LRU cache
+CAPTION_CACHE_SIZE = 32
+
+# Number of BLIP-2 image embeddings kept so prompt changes skip the ViT and Q-Former
+EMBEDDING_CACHE_SIZE = 8
+
+# Number of tokenized BLIP-2 prompts kept on the device
+PROMPT_CACHE_SIZE = 128
+
+# Static KV cache sizes for BLIP-2 decode; each bucket gets its own CUDA graph
+MAX_NEW_TOKENS_BUCKETS = (64, 128, 256, 512)
+
+# Prompt lengths and batch sizes are rounded up so the T5 encoder and cross-attention
+# shapes repeat across prompts instead of recompiling and recording a graph per length
+PROMPT_LENGTH_MULTIPLE = 32
+
+# Seconds after its last select_models() call that a session stops holding its models
+SESSION_TIMEOUT = 30 * 60
 
 class DualImageCaptioning:
-    def __init__(self, device="auto"):
+    def __init__(self, device="auto", quantization="fp16"):
         """
-        Initialize both BLIP and BLIP-2 models
+        Configure BLIP and BLIP-2 models; each model loads on first use
         
         Args:
             device: Device to run models on ("auto", "cuda", "cpu")
+            quantization: Weight precision on GPU ("fp16", "int8", "nf4"); "fp16"
+                uses BF16 instead on GPUs that support it
         """
         # Determine device
         if device == "auto":
@@ -17,116 +48,915 @@ class DualImageCaptioning:
         else:
             self.device = device
             
-        print(f"Using device: {self.device}")
+        if quantization not in ("fp16", "int8", "nf4"):
+            raise ValueError(f"Unsupported quantization: {quantization}")
+        
+        # bitsandbytes kernels are CUDA-only, so CPU always loads full FP32 weights
+        if self.device != "cuda" and quantization != "fp16":
+            print(f"Quantization '{quantization}' requires CUDA, falling back to fp32 on CPU")
+            quantization = "fp16"
+        self.quantization = quantization
+        
+        # BF16 keeps FP32's dynamic range at FP16 tensor-core speed on Ampere and newer
+        if self.device == "cuda":
+            self.dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            self.dtype = torch.float32
+            
+        print(f"Using device: {self.device} ({self.quantization}, {self.dtype})")
+        
+        # reduce-overhead compilation only pays off through CUDA graphs, and bitsandbytes
+        # layers are not traceable, so only full-precision GPU weights are compiled;
+        # CUDA graph decode additionally needs a static KV cache on the GPU
+        self.use_compile = hasattr(torch, "compile") and self.device == "cuda" and self.quantization == "fp16"
+        self.use_cuda_graphs = False
+        self.use_static_cache = False
+        
+        # LRU cache of generated captions keyed on image hash, model and prompt
+        self._cache = OrderedDict()
+        
+        # LRU cache of BLIP-2 language model image inputs keyed on image hash
+        self._embedding_cache = OrderedDict()
+        
+        # LRU cache of tokenized BLIP-2 prompts keyed on the prompt string(s)
+        self._prompt_cache = OrderedDict()
+        
+        # Guards the caches against concurrent sessions and the model worker threads
+        self._cache_lock = threading.Lock()
+        
+        # Models are loaded lazily so a session only pays for the models it uses;
+        # loading, unloading and generation are serialized on each model's worker thread
+        self.blip_processor = None
+        self.blip_model = None
+        self.blip2_processor = None
+        self.blip2_model = None
+        
+        # (blip, blip2, last seen) selection of every session that called select_models
+        self._selections = {}
+        self._selection_lock = threading.Lock()
+        
+        # Per-worker-thread state, such as each worker's host-to-device copy stream
+        self._worker_state = threading.local()
+        
+        # Each model loads, warms up and generates on one long-lived worker thread:
+        # torch.compile records CUDA graphs per thread, so warmup and requests must
+        # share a thread, and a thread per model lets both models decode at once
+        self._blip_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="blip", initializer=self._init_worker)
+        self._blip2_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="blip2", initializer=self._init_worker)
+    
+    def _init_worker(self):
+        """
+        Give a model worker thread its own compute and copy streams so both models' kernels can overlap
+        """
+        if self.device == "cuda":
+            torch.cuda.set_stream(torch.cuda.Stream())
+            
+            # A shared copy stream would make one model's input copy wait on the other's compute
+            self._worker_state.copy_stream = torch.cuda.Stream()
+    
+    def load_blip(self):
+        """
+        Load the BLIP model if it is not loaded yet
+        """
+        self._blip_worker.submit(self._load_blip).result()
+    
+    def load_blip2(self):
+        """
+        Load the BLIP-2 model if it is not loaded yet
+        """
+        self._blip2_worker.submit(self._load_blip2).result()
+    
+    def _load_blip(self):
+        """
+        Load the BLIP model on the BLIP worker thread
+        """
+        if self.blip_model is not None:
+            return
         
-        # Load BLIP (original) model
         print("Loading BLIP model...")
         self.blip_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-        self.blip_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large")
+        model = self._from_pretrained(BlipForConditionalGeneration, "Salesforce/blip-image-captioning-large")
         
+        if self.device == "cuda" and self.quantization == "fp16":
+            model = model.to(self.device)
+        model.eval()
+        
+        # On GPU the image is resized and normalized there instead of by the processor
         if self.device == "cuda":
-            self.blip_model = self.blip_model.to(self.device)
+            self._blip_transform = self._build_blip_transform()
+        
+        # Greedy decoding with the KV cache enabled, built once instead of per call
+        self.blip_generation_config = copy.deepcopy(model.text_decoder.generation_config)
+        self.blip_generation_config.update(num_beams=1, do_sample=False, use_cache=True)
+        
+        if self.use_compile:
+            self._compile_blip(model)
+        
+        # blip_model marks BLIP as loaded, so it is only set once setup and warmup
+        # succeed; a failed load is retried in full on the next call
+        self.blip_model = model
+        print("BLIP model loaded successfully!")
+    
+    def _load_blip2(self):
+        """
+        Load the BLIP-2 model on the BLIP-2 worker thread
+        """
+        if self.blip2_model is not None:
+            return
         
-        # Load BLIP-2 model
         print("Loading BLIP-2 model...")
         self.blip2_processor = Blip2Processor.from_pretrained("Salesforce/blip2-flan-t5-xl")
         
+        # For FP16 and bitsandbytes loads transformers keeps the modules listed in
+        # _keep_in_fp32_modules (Q-Former, query tokens, FLAN-T5 wo layers) in FP32,
+        # which avoids FP16 overflow on pre-Ampere GPUs; BF16 loads need no exception.
+        # FLAN-T5 has no SDPA or Flash-Attention 2 kernels, so only the ViT and Q-Former get them
+        model = self._from_pretrained(Blip2ForConditionalGeneration, "Salesforce/blip2-flan-t5-xl", eager_sub_configs=("text_config",))
+        
+        if self.device == "cuda" and self.quantization == "fp16":
+            model = model.to(self.device)
+        model.eval()
+        
+        # Greedy decoding built once from the decoder's own config (which holds the
+        # FLAN-T5 start/end tokens) instead of relying on per-call defaults
+        self.blip2_generation_config = copy.deepcopy(model.language_model.generation_config)
+        self.blip2_generation_config.update(
+            num_beams=1,
+            do_sample=False,
+            use_cache=True,
+            pad_token_id=self.blip2_processor.tokenizer.pad_token_id
+        )
+        
+        # A static KV cache is preallocated once per bucket, avoiding per-token
+        # reallocation and allowing the decode step to be captured as a CUDA graph;
+        # older transformers releases have no static cache for T5, so keep the dynamic one there
+        self.use_static_cache = getattr(model.language_model, "_supports_static_cache", False)
+        if self.use_static_cache:
+            self.blip2_generation_config.cache_implementation = "static"
+        
+        if self.use_compile:
+            self.use_cuda_graphs = self.use_static_cache
+            self._compile_blip2(model)
+        
+        # blip2_model marks BLIP-2 as loaded, so it is only set once setup and warmup
+        # succeed; a failed load is retried in full on the next call
+        self.blip2_model = model
+        print("BLIP-2 model loaded successfully!")
+    
+    def unload_blip(self):
+        """
+        Release the BLIP model if it is loaded, after any generation already queued for it
+        
+        Returns:
+            True if a model was released
+        """
+        return self._blip_worker.submit(self._unload_blip).result()
+    
+    def unload_blip2(self):
+        """
+        Release the BLIP-2 model and its cached image embeddings and prompts if it is
+        loaded, after any generation already queued for it
+        
+        Returns:
+            True if a model was released
+        """
+        return self._blip2_worker.submit(self._unload_blip2).result()
+    
+    def _unload_blip(self, if_unused=False):
+        """
+        Release the BLIP model on the BLIP worker thread
+        
+        Args:
+            if_unused: Keep the model if an active session still uses it
+            
+        Returns:
+            True if a model was released
+        """
+        if self.blip_model is None or (if_unused and self._models_in_use()[0]):
+            return False
+        self.blip_model = None
+        return True
+    
+    def _unload_blip2(self, if_unused=False):
+        """
+        Release the BLIP-2 model on the BLIP-2 worker thread
+        
+        Args:
+            if_unused: Keep the model if an active session still uses it
+            
+        Returns:
+            True if a model was released
+        """
+        if self.blip2_model is None or (if_unused and self._models_in_use()[1]):
+            return False
+        self.blip2_model = None
+        with self._cache_lock:
+            self._embedding_cache.clear()
+            self._prompt_cache.clear()
+        return True
+    
+    def select_models(self, session, blip=True, blip2=True):
+        """
+        Record the models a session uses and release the ones no active session needs
+        
+        Models are not loaded here; they still load on first use. A model is only
+        released once no session seen in the last SESSION_TIMEOUT seconds uses it, so
+        sessions with different selections do not evict each other's models. Releasing
+        happens on the model's worker thread after any queued generation and does not
+        block the caller.
+        
+        Args:
+            session: Hashable id of the calling session
+            blip: Whether the session uses BLIP
+            blip2: Whether the session uses BLIP-2
+        """
+        with self._selection_lock:
+            self._selections[session] = (blip, blip2, time.monotonic())
+        
+        blip_in_use, blip2_in_use = self._models_in_use()
+        if not blip_in_use:
+            self._blip_worker.submit(self._release_unused, self._unload_blip)
+        if not blip2_in_use:
+            self._blip2_worker.submit(self._release_unused, self._unload_blip2)
+    
+    def _models_in_use(self):
+        """
+        Check which models any active session uses
+        
+        Returns:
+            Tuple of (BLIP in use, BLIP-2 in use)
+        """
+        cutoff = time.monotonic() - SESSION_TIMEOUT
+        with self._selection_lock:
+            # Forget sessions that stopped rerunning, e.g. closed browser tabs
+            self._selections = {
+                session: selection for session, selection in self._selections.items()
+                if selection[2] >= cutoff
+            }
+            selections = list(self._selections.values())
+        return any(s[0] for s in selections), any(s[1] for s in selections)
+    
+    def _release_unused(self, unload):
+        """
+        Release a model on its worker thread unless a session selected it meanwhile
+        
+        Args:
+            unload: _unload_blip or _unload_blip2
+        """
+        # gc.collect() is expensive, so only pay for it when a model was actually freed
+        if unload(if_unused=True):
+            gc.collect()
+            if self.device == "cuda":
+                torch.cuda.empty_cache()
+    
+    def close(self):
+        """
+        Release both models and stop the worker threads
+        
+        Generation already running finishes first and queued work is cancelled;
+        the captioner cannot be used afterwards.
+        """
+        self._blip_worker.shutdown(cancel_futures=True)
+        self._blip2_worker.shutdown(cancel_futures=True)
+        
+        # The workers have exited, so the models can be released from this thread
+        self._unload_blip()
+        self._unload_blip2()
+        gc.collect()
         if self.device == "cuda":
-            self.blip2_model = Blip2ForConditionalGeneration.from_pretrained(
-                "Salesforce/blip2-flan-t5-xl", 
-                torch_dtype=torch.float16
-            ).to(self.device)
-        else:
-            self.blip2_model = Blip2ForConditionalGeneration.from_pretrained(
-                "Salesforce/blip2-flan-t5-xl"
+            torch.cuda.empty_cache()
+    
+    def _load_kwargs(self):
+        """
+        Build the from_pretrained keyword arguments for the selected precision
+        
+        Returns:
+            Dictionary of keyword arguments for from_pretrained
+        """
+        if self.device != "cuda":
+            return {}
+        
+        kwargs = {"torch_dtype": self.dtype}
+        
+        if self.quantization == "int8":
+            kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+            kwargs["device_map"] = "auto"
+        elif self.quantization == "nf4":
+            kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=self.dtype
             )
+            kwargs["device_map"] = "auto"
+            
+        return kwargs
+    
+    def _from_pretrained(self, model_class, model_name, eager_sub_configs=()):
+        """
+        Load a model with the fastest attention implementation available
+        
+        Args:
+            model_class: transformers model class to load
+            model_name: Hugging Face model id
+            eager_sub_configs: Sub-configs whose models have no fused attention kernels
+                and always load with eager attention
+            
+        Returns:
+            Loaded model
+        """
+        # Flash-Attention 2 only runs on GPU in half precision; SDPA works everywhere
+        attn_implementations = ["sdpa"]
+        if self.device == "cuda":
+            attn_implementations.insert(0, "flash_attention_2")
+        
+        # Composite models take one implementation per sub-model, so a language model
+        # without fused kernels does not force the vision encoder back to eager as well
+        sub_configs = model_class.config_class.sub_configs
+        
+        model = None
+        for attn_implementation in attn_implementations:
+            requested = {
+                key: "eager" if key in eager_sub_configs else attn_implementation
+                for key in sub_configs
+            } or attn_implementation
+            try:
+                model = model_class.from_pretrained(model_name, attn_implementation=requested, **self._load_kwargs())
+                break
+            except (ImportError, ValueError) as e:
+                # Only a missing attention kernel is worth retrying; any other load error
+                # (e.g. a bitsandbytes device_map offload error) would fail the same way again
+                if "attention" not in str(e).lower():
+                    raise
+                print(f"{attn_implementation} unavailable for {model_name}: {e}")
+        
+        if model is None:
+            model = model_class.from_pretrained(model_name, attn_implementation="eager", **self._load_kwargs())
+        
+        config = model.config
+        loaded = {key: getattr(config, key)._attn_implementation for key in sub_configs} or config._attn_implementation
+        print(f"Loaded {model_name} with attention: {loaded}")
+        return model
+    
+    @torch.inference_mode()
+    def _compile_blip(self, model, warmup_steps=3):
+        """
+        Compile the BLIP vision encoder and warm it up
+        
+        Args:
+            model: BLIP model being loaded
+            warmup_steps: Number of warmup calls used for autotuning and graph capture
+        """
+        print("Compiling BLIP model...")
+        
+        # Compile the submodules generate() actually calls; wrapping the whole model
+        # would leave generate() running the uncompiled module underneath
+        model.vision_model.forward = torch.compile(model.vision_model.forward, mode="reduce-overhead", fullgraph=False)
+        
+        # Pay compile and autotuning cost here rather than on the first click
+        dummy_image = Image.new("RGB", (224, 224))
+        for _ in range(warmup_steps):
+            self._generate_blip(dummy_image, "a photography of", model)
+    
+    @torch.inference_mode()
+    def _compile_blip2(self, model, warmup_steps=3):
+        """
+        Compile the BLIP-2 forward path and warm it up
+        
+        Args:
+            model: BLIP-2 model being loaded
+            warmup_steps: Number of warmup calls per static cache bucket used for
+                autotuning and graph capture
+        """
+        print("Compiling BLIP-2 model...")
+        
+        model.vision_model.forward = torch.compile(model.vision_model.forward, mode="reduce-overhead", fullgraph=False)
+        model.qformer.forward = torch.compile(model.qformer.forward, mode="reduce-overhead", fullgraph=False)
         
-        print("Both models loaded successfully!")
+        # The static-cache decoder step is captured and replayed as a CUDA graph
+        if self.use_cuda_graphs:
+            language_model = model.language_model
+            language_model.forward = torch.compile(language_model.forward, mode="reduce-overhead", fullgraph=False)
+        
+        # Pay compile, autotuning and capture cost here rather than on the first click;
+        # this runs on the BLIP-2 worker thread, which is where the graphs are replayed.
+        # Each static cache bucket is its own shape, so all of them are warmed up, or the
+        # app's default of 200 tokens (bucket 256) would still record on the first click
+        dummy_image = Image.new("RGB", (224, 224))
+        buckets = MAX_NEW_TOKENS_BUCKETS if self.use_static_cache else MAX_NEW_TOKENS_BUCKETS[:1]
+        for bucket in buckets:
+            for _ in range(warmup_steps):
+                self._generate_blip2(dummy_image, "Describe this image.", bucket, model=model)
+    
+    def _bucket_max_new_tokens(self, max_new_tokens):
+        """
+        Round max_new_tokens up to the nearest static cache bucket
+        
+        Args:
+            max_new_tokens: Requested maximum number of new tokens
+            
+        Returns:
+            Smallest bucket that fits the request, or the request itself if none does
+        """
+        for bucket in MAX_NEW_TOKENS_BUCKETS:
+            if bucket >= max_new_tokens:
+                return bucket
+        return max_new_tokens
+    
+    def _load_image(self, image):
+        """
+        Return an RGB PIL image from a path or an already decoded image
+        
+        Args:
+            image: Path to the image file or a PIL Image
+            
+        Returns:
+            RGB PIL Image
+        """
+        if isinstance(image, Image.Image):
+            return image if image.mode == "RGB" else image.convert("RGB")
+        return Image.open(image).convert("RGB")
     
-    def generate_blip_caption(self, image_path, text_prompt="a photography of"):
+    @staticmethod
+    def hash_image(image):
+        """
+        Compute the cache key digest for an image
+        
+        Args:
+            image: Path to the image file, raw image bytes or a PIL Image
+            
+        Returns:
+            16-byte blake2b digest
+        """
+        if isinstance(image, Image.Image):
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(f"{image.mode}{image.size}".encode())
+            hasher.update(image.tobytes())
+            return hasher.digest()
+        if isinstance(image, (bytes, bytearray)):
+            return hashlib.blake2b(image, digest_size=16).digest()
+        with open(image, "rb") as f:
+            return hashlib.blake2b(f.read(), digest_size=16).digest()
+    
+    def _cached(self, key, generate, cache=None, max_size=CAPTION_CACHE_SIZE):
+        """
+        Return a cached value or generate and store it
+        
+        Args:
+            key: Cache key tuple
+            generate: Callable producing the value on a cache miss
+            cache: LRU OrderedDict to use, the caption cache by default
+            max_size: Maximum number of entries kept in the cache
+            
+        Returns:
+            Cached or newly generated value
+        """
+        if cache is None:
+            cache = self._cache
+        
+        with self._cache_lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        
+        # The lock is not held while generating so other sessions are not blocked
+        value = generate()
+        with self._cache_lock:
+            cache[key] = value
+            if len(cache) > max_size:
+                cache.popitem(last=False)
+        return value
+    
+    def _cache_get(self, key):
+        """
+        Return a cached caption, marking it recently used
+        
+        Args:
+            key: Cache key tuple
+            
+        Returns:
+            Cached caption, or None on a miss
+        """
+        with self._cache_lock:
+            if key not in self._cache:
+                return None
+            self._cache.move_to_end(key)
+            return self._cache[key]
+    
+    def generate_blip_caption(self, image, text_prompt="a photography of", image_hash=None):
         """
         Generate caption using BLIP model
         
         Args:
-            image_path: Path to the image file
+            image: Path to the image file or a PIL Image
             text_prompt: Text prompt to guide caption generation
+            image_hash: Precomputed hash_image() digest, computed if not given
             
         Returns:
             Generated caption string
         """
-        # Load the Image
-        raw_image = Image.open(image_path).convert('RGB')
+        if image_hash is None:
+            image_hash = self.hash_image(image)
+        key = (image_hash, "blip", text_prompt)
+        return self._cached(key, lambda: self._blip_worker.submit(self._blip_task, self._load_image(image), text_prompt).result())
+    
+    def _to_device(self, inputs):
+        """
+        Move processor outputs to the model device, casting floats to the compute dtype on GPU
         
-        # Prepare the Inputs
-        inputs = self.blip_processor(raw_image, text_prompt, return_tensors="pt")
+        Args:
+            inputs: Processor output mapping of tensors
+            
+        Returns:
+            Dictionary of tensors on the model device
+        """
+        if self.device != "cuda":
+            return dict(inputs)
         
-        if self.device == "cuda":
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        # Copy from pinned host memory on a side stream so the H2D transfer is
+        # asynchronous and does not block launches queued on the compute stream
+        compute_stream = torch.cuda.current_stream()
+        copy_stream = self._worker_state.copy_stream
+        copy_stream.wait_stream(compute_stream)
+        with torch.cuda.stream(copy_stream):
+            moved = {}
+            for k, v in inputs.items():
+                dtype = self.dtype if v.is_floating_point() else v.dtype
+                moved[k] = v.pin_memory().to(self.device, dtype, non_blocking=True)
+        
+        compute_stream.wait_stream(copy_stream)
+        for v in moved.values():
+            # The tensors were allocated on the copy stream but are consumed on the compute stream
+            v.record_stream(compute_stream)
+        return moved
+    
+    def _build_blip_transform(self):
+        """
+        Build a GPU equivalent of the BLIP image processor's resize and normalization
+        
+        Returns:
+            torchvision v2 transform for batched uint8 image tensors
+        """
+        image_processor = self.blip_processor.image_processor
+        size = (image_processor.size["height"], image_processor.size["width"])
+        
+        # The processor resizes straight to the target size (no crop) with bicubic resampling
+        return v2.Compose([
+            v2.Resize(size, interpolation=v2.InterpolationMode.BICUBIC, antialias=True),
+            v2.ToDtype(self.dtype, scale=True),
+            v2.Normalize(mean=image_processor.image_mean, std=image_processor.image_std)
+        ])
+    
+    def _prepare_blip_inputs(self, raw_image, text_prompt):
+        """
+        Preprocess an image and prompt for the BLIP model
+        
+        Args:
+            raw_image: RGB PIL Image
+            text_prompt: Text prompt to guide caption generation
+            
+        Returns:
+            Dictionary of input tensors on the model device
+        """
+        if self.device != "cuda":
+            return self._to_device(self.blip_processor(raw_image, text_prompt, return_tensors="pt"))
+        
+        # Only the uint8 pixels go through _to_device; resizing and normalization run on the GPU
+        image = v2.functional.pil_to_tensor(raw_image).unsqueeze(0)
+        
+        # The BERT tokenizer adds token_type_ids, which BLIP's text decoder rejects;
+        # BlipProcessor drops them the same way
+        text_inputs = self.blip_processor.tokenizer(text_prompt, return_token_type_ids=False, return_tensors="pt")
+        inputs = self._to_device({"image": image, **text_inputs})
+        inputs["pixel_values"] = self._blip_transform(inputs.pop("image"))
+        return inputs
+    
+    @torch.inference_mode()
+    def _generate_blip(self, raw_image, text_prompt, model=None):
+        """
+        Run the BLIP model on a decoded image without caching
+        
+        Args:
+            raw_image: RGB PIL Image
+            text_prompt: Text prompt to guide caption generation
+            model: BLIP model to run, the loaded one by default
+            
+        Returns:
+            Generated caption string
+        """
+        if model is None:
+            model = self.blip_model
+        inputs = self._prepare_blip_inputs(raw_image, text_prompt)
         
         # Generate the Caption
-        with torch.no_grad():
-            output = self.blip_model.generate(**inputs)
+        output = model.generate(**inputs, generation_config=self.blip_generation_config)
             
         return self.blip_processor.decode(output[0], skip_special_tokens=True)
     
-    def generate_blip2_caption(self, image_path, prompt="Describe this image in detail with at least three sentences.", max_new_tokens=200):
+    def _blip_task(self, raw_image, text_prompt):
+        """
+        Load BLIP if needed and caption an image on the BLIP worker thread
+        
+        Args:
+            raw_image: RGB PIL Image
+            text_prompt: Text prompt to guide caption generation
+            
+        Returns:
+            Generated caption string
+        """
+        self._load_blip()
+        return self._generate_blip(raw_image, text_prompt)
+    
+    def generate_blip2_caption(self, image, prompt="Describe this image in detail with at least three sentences.", max_new_tokens=200, image_hash=None):
         """
         Generate caption using BLIP-2 model
         
         Args:
-            image_path: Path to the image file
+            image: Path to the image file or a PIL Image
             prompt: Text prompt to guide caption generation
             max_new_tokens: Maximum number of new tokens to generate
+            image_hash: Precomputed hash_image() digest, computed if not given
             
         Returns:
             Generated caption string
         """
-        # Load the Image
-        raw_image = Image.open(image_path).convert("RGB")
+        return self.generate_blip2_captions(image, [prompt], max_new_tokens, image_hash)[0]
+    
+    def generate_blip2_captions(self, image, prompts, max_new_tokens=200, image_hash=None):
+        """
+        Generate BLIP-2 captions for several prompts in a single batched generate()
         
-        # Prepare the Inputs
-        inputs = self.blip2_processor(raw_image, prompt, return_tensors="pt")
+        Args:
+            image: Path to the image file or a PIL Image
+            prompts: List of text prompts to guide caption generation
+            max_new_tokens: Maximum number of new tokens to generate
+            image_hash: Precomputed hash_image() digest, computed if not given
+            
+        Returns:
+            List of generated caption strings, one per prompt
+        """
+        if image_hash is None:
+            image_hash = self.hash_image(image)
+        captions, missing = self._cached_blip2_captions(image_hash, prompts, max_new_tokens)
         
-        if self.device == "cuda":
-            inputs = {k: v.to(self.device, torch.float16) for k, v in inputs.items()}
+        if missing:
+            decoded = self._blip2_worker.submit(self._blip2_task, self._load_image(image), missing, max_new_tokens, image_hash).result()
+            self._store_blip2_captions(captions, image_hash, missing, max_new_tokens, decoded)
+            
+        return [captions[prompt] for prompt in prompts]
+    
+    def _cached_blip2_captions(self, image_hash, prompts, max_new_tokens):
+        """
+        Look up cached BLIP-2 captions for several prompts
         
-        # Generate the Caption
-        with torch.no_grad():
-            output = self.blip2_model.generate(**inputs, max_new_tokens=max_new_tokens)
+        Args:
+            image_hash: hash_image() digest
+            prompts: List of text prompts
+            max_new_tokens: Maximum number of new tokens to generate
+            
+        Returns:
+            Tuple of (dictionary of cached captions by prompt, list of unique uncached prompts)
+        """
+        captions = {}
+        for prompt in prompts:
+            caption = self._cache_get((image_hash, "blip2", prompt, max_new_tokens))
+            if caption is not None:
+                captions[prompt] = caption
+        missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in captions]
+        return captions, missing
+    
+    def _store_blip2_captions(self, captions, image_hash, prompts, max_new_tokens, decoded):
+        """
+        Store batched BLIP-2 captions in the cache
+        
+        Args:
+            captions: Dictionary of captions by prompt, updated in place
+            image_hash: hash_image() digest
+            prompts: List of prompts the captions were generated for
+            max_new_tokens: Maximum number of new tokens to generate
+            decoded: Generated caption strings, one per prompt
+        """
+        for prompt, caption in zip(prompts, decoded):
+            key = (image_hash, "blip2", prompt, max_new_tokens)
+            captions[prompt] = self._cached(key, lambda: caption)
+    
+    @torch.inference_mode()
+    def _encode_image(self, model, raw_image, image_hash=None):
+        """
+        Run the BLIP-2 vision encoder, Q-Former and projection for an image
+        
+        The result only depends on the image, so it is cached by image hash and
+        reused when only the prompt changes.
+        
+        Args:
+            model: BLIP-2 model to run
+            raw_image: RGB PIL Image
+            image_hash: hash_image() digest; the result is not cached if None
             
-        return self.blip2_processor.decode(output[0], skip_special_tokens=True)
+        Returns:
+            Language model image inputs of shape (1, num_query_tokens, hidden_size)
+        """
+        def encode():
+            pixel_values = self._to_device(self.blip2_processor.image_processor(raw_image, return_tensors="pt"))["pixel_values"]
+            image_embeds = model.vision_model(pixel_values=pixel_values, return_dict=True).last_hidden_state
+            image_attention_mask = torch.ones(image_embeds.shape[:-1], dtype=torch.long, device=image_embeds.device)
+            
+            query_tokens = model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+            query_output = model.qformer(
+                query_embeds=query_tokens,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_attention_mask,
+                return_dict=True
+            ).last_hidden_state
+            
+            # The Q-Former may be kept in FP32 while the projection runs in FP16
+            query_output = query_output.to(image_embeds.dtype)
+            return model.language_projection(query_output)
+        
+        if image_hash is None:
+            return encode()
+        return self._cached((image_hash,), encode, cache=self._embedding_cache, max_size=EMBEDDING_CACHE_SIZE)
+    
+    def _tokenize_blip2(self, prompt):
+        """
+        Tokenize one or more BLIP-2 prompts, reusing earlier results for the same text
+        
+        Args:
+            prompt: Text prompt, or list of prompts to tokenize as a padded batch
+            
+        Returns:
+            Dictionary with input_ids and attention_mask on the model device
+        """
+        # Padded positions are masked out, so bucketing the length does not change the output
+        pad_to_multiple_of = PROMPT_LENGTH_MULTIPLE if self.use_cuda_graphs else None
+        
+        key = tuple(prompt) if isinstance(prompt, list) else (prompt,)
+        return self._cached(
+            key,
+            lambda: self._to_device(self.blip2_processor.tokenizer(
+                prompt,
+                padding=True,
+                truncation=True,
+                pad_to_multiple_of=pad_to_multiple_of,
+                return_tensors="pt"
+            )),
+            cache=self._prompt_cache,
+            max_size=PROMPT_CACHE_SIZE
+        )
     
-    def generate_both_captions(self, image_path, blip_prompt="a photography of", blip2_prompt="Describe this image in detail with at least three sentences.", max_new_tokens=200):
+    def _prepare_blip2_inputs(self, model, raw_image, prompt, image_hash=None):
+        """
+        Preprocess an image and one or more prompts for the BLIP-2 model
+        
+        Args:
+            model: BLIP-2 model to run
+            raw_image: RGB PIL Image
+            prompt: Text prompt, or list of prompts to batch against the same image
+            image_hash: hash_image() digest used to reuse the image encoding
+            
+        Returns:
+            Dictionary of input tensors on the model device; batches may carry extra
+            padding rows after the requested prompts
+        """
+        # Round batches up to a power of two by repeating the last prompt; callers
+        # zip the output with their own prompt list, which drops the extra rows
+        if isinstance(prompt, list) and self.use_cuda_graphs:
+            batch_size = 1 << (len(prompt) - 1).bit_length()
+            prompt = prompt + [prompt[-1]] * (batch_size - len(prompt))
+        
+        text_inputs = self._tokenize_blip2(prompt)
+        inputs_embeds = model.get_input_embeddings()(text_inputs["input_ids"])
+        
+        # Prepend the (cached) query embeddings to every prompt in the batch
+        language_model_inputs = self._encode_image(model, raw_image, image_hash)
+        language_model_inputs = language_model_inputs.to(inputs_embeds.dtype).expand(inputs_embeds.shape[0], -1, -1)
+        image_attention_mask = torch.ones(language_model_inputs.shape[:-1], dtype=text_inputs["attention_mask"].dtype, device=inputs_embeds.device)
+        
+        return {
+            "inputs_embeds": torch.cat([language_model_inputs, inputs_embeds], dim=1),
+            "attention_mask": torch.cat([image_attention_mask, text_inputs["attention_mask"]], dim=1)
+        }
+    
+    @torch.inference_mode()
+    def _blip2_generate(self, model, inputs, max_new_tokens):
+        """
+        Run BLIP-2 generate() on prepared inputs
+        
+        Args:
+            model: BLIP-2 model to run
+            inputs: Dictionary of input tensors on the model device
+            max_new_tokens: Maximum number of new tokens to generate
+            
+        Returns:
+            Generated token ids
+        """
+        # The inputs already carry the image embeddings, so only the decoder runs
+        language_model = model.language_model
+        
+        if self.use_static_cache:
+            # Size the static cache by bucket so it (and its CUDA graph) is reused across
+            # lengths, but still stop at the requested number of tokens (+1 start token);
+            # transformers>=4.50 lets this criterion replace generate()'s own MaxLengthCriteria
+            return language_model.generate(
+                **inputs,
+                generation_config=self.blip2_generation_config,
+                max_new_tokens=self._bucket_max_new_tokens(max_new_tokens),
+                stopping_criteria=StoppingCriteriaList([MaxLengthCriteria(max_new_tokens + 1)])
+            )
+        return language_model.generate(**inputs, generation_config=self.blip2_generation_config, max_new_tokens=max_new_tokens)
+    
+    @torch.inference_mode()
+    def _generate_blip2(self, raw_image, prompt, max_new_tokens, image_hash=None, model=None):
+        """
+        Run the BLIP-2 model on a decoded image without caching the caption
+        
+        Args:
+            raw_image: RGB PIL Image
+            prompt: Text prompt, or list of prompts to batch against the same image
+            max_new_tokens: Maximum number of new tokens to generate
+            image_hash: hash_image() digest used to reuse the image encoding
+            model: BLIP-2 model to run, the loaded one by default
+            
+        Returns:
+            Generated caption string, or a list of captions for a list of prompts
+        """
+        if model is None:
+            model = self.blip2_model
+        inputs = self._prepare_blip2_inputs(model, raw_image, prompt, image_hash)
+        output = self._blip2_generate(model, inputs, max_new_tokens)
+        decoded = self.blip2_processor.batch_decode(output, skip_special_tokens=True)
+        
+        # Drop the rows added to pad the batch
+        return decoded[:len(prompt)] if isinstance(prompt, list) else decoded[0]
+    
+    def _blip2_task(self, raw_image, prompts, max_new_tokens, image_hash):
+        """
+        Load BLIP-2 if needed and caption an image on the BLIP-2 worker thread
+        
+        Args:
+            raw_image: RGB PIL Image
+            prompts: List of text prompts to batch against the image
+            max_new_tokens: Maximum number of new tokens to generate
+            image_hash: hash_image() digest used to reuse the image encoding
+            
+        Returns:
+            List of generated caption strings, one per prompt
+        """
+        self._load_blip2()
+        return self._generate_blip2(raw_image, prompts, max_new_tokens, image_hash)
+    
+    def generate_both_captions(self, image, blip_prompt="a photography of", blip2_prompt="Describe this image in detail with at least three sentences.", max_new_tokens=200, image_hash=None):
         """
         Generate captions using both models
         
         Args:
-            image_path: Path to the image file
+            image: Path to the image file or a PIL Image
             blip_prompt: Prompt for BLIP model
-            blip2_prompt: Prompt for BLIP-2 model
+            blip2_prompt: Prompt for BLIP-2 model, or a list of prompts batched
+                into a single BLIP-2 generate()
             max_new_tokens: Maximum tokens for BLIP-2
+            image_hash: Precomputed hash_image() digest, computed if not given
             
         Returns:
-            Dictionary with captions from both models
+            Dictionary with captions from both models; 'blip2' is a list when
+            blip2_prompt is a list
         """
         results = {}
         
-        print("Generating BLIP caption...")
-        results['blip'] = self.generate_blip_caption(image_path, blip_prompt)
+        # Decode and hash once and share the image between both models
+        raw_image = self._load_image(image)
+        if image_hash is None:
+            image_hash = self.hash_image(image)
+        
+        blip2_prompts = blip2_prompt if isinstance(blip2_prompt, list) else [blip2_prompt]
+        blip_key = (image_hash, "blip", blip_prompt)
+        blip_caption = self._cache_get(blip_key)
+        blip2_captions, blip2_missing = self._cached_blip2_captions(image_hash, blip2_prompts, max_new_tokens)
+        
+        # Submit both models before waiting on either so they decode at the same time,
+        # each on its own worker thread and CUDA stream
+        print("Generating BLIP and BLIP-2 captions...")
+        if blip_caption is None:
+            blip_future = self._blip_worker.submit(self._blip_task, raw_image, blip_prompt)
+        if blip2_missing:
+            blip2_future = self._blip2_worker.submit(self._blip2_task, raw_image, blip2_missing, max_new_tokens, image_hash)
+        
+        results['blip'] = blip_caption if blip_caption is not None else self._cached(blip_key, blip_future.result)
+        if blip2_missing:
+            self._store_blip2_captions(blip2_captions, image_hash, blip2_missing, max_new_tokens, blip2_future.result())
+        blip2_results = [blip2_captions[prompt] for prompt in blip2_prompts]
         
-        print("Generating BLIP-2 caption...")
-        results['blip2'] = self.generate_blip2_caption(image_path, blip2_prompt, max_new_tokens)
+        results['blip2'] = blip2_results if isinstance(blip2_prompt, list) else blip2_results[0]
         
         return results
     
-    def compare_captions(self, image_path):
+    def compare_captions(self, image):
         """
         Generate and compare captions from both models
         
         Args:
-            image_path: Path to the image file
+            image: Path to the image file or a PIL Image
         """
-        captions = self.generate_both_captions(image_path)
+        captions = self.generate_both_captions(image)
         
         print("\n" + "="*50)
         print("CAPTION COMPARISON")